@@ -1,10 +1,23 @@
+import functools
 import logging
+import os
 from pathlib import Path
-from typing import Literal, Optional, Union
+from typing import Literal, NamedTuple, Optional, Tuple, Union
 
 import geoutils as gu
+import numpy as np
 import pyproj
+import rasterio
+import rasterio.warp
 import xdem
+from affine import Affine
+from numba import njit, prange
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import transform as window_transform
+
+from gtiff_options import get_cog_opts
 
 # Set up logging
 logging.basicConfig(
@@ -14,86 +27,920 @@ logging.basicConfig(
 )
 logger = logging.getLogger()
 
+# Use all the available cores for GDAL warping and keep warp chunks in memory (MB)
+NUM_THREADS = os.cpu_count()
+WARP_MEM_LIMIT = 512
+os.environ.setdefault("GDAL_NUM_THREADS", "ALL_CPUS")
+
+# Largest misalignment, in pixels, for which a grid is treated as a subset of another one
+ALIGNMENT_TOLERANCE = 1e-6
+
+# Number of pixels in the row strips used for in-memory raster arithmetic
+OP_STRIP_PIXELS = 2**20
+
+# Number of target pixels resampled at once before being quantized when resampling geoids
+STRIP_PIXELS = 2**20
+
+# Spacing in pixels of the control points whose coordinates are transformed exactly when
+# resampling geoids. The coordinates in between are interpolated bilinearly, as done by
+# the approximate transformer of GDAL.
+CONTROL_STEP = 16
+
+# Geoid heights on DEM grids kept in the geoid cache are stored as int16 millimetres
+# relative to their median, which halves the memory they take compared to float32
+GEOID_SCALE = 1000
+QUANTIZED_NODATA = -32768
+
+
+class _Grid(NamedTuple):
+    """Georeferenced grid of a raster, hashable so that it can be used as a cache key."""
+
+    transform: Affine
+    shape: Tuple[int, int]
+    crs: CRS
+
+
+class _QuantizedGeoid(NamedTuple):
+    """Geoid heights stored as int16 multiples of 1 / GEOID_SCALE relative to an offset."""
+
+    values: np.ndarray
+    offset: float
+
+
+class _RasterArray(NamedTuple):
+    """Masked array with its georeferencing, passed around instead of gu.Raster objects."""
+
+    data: np.ma.MaskedArray
+    transform: Affine
+    crs: CRS
+    nodata: Optional[float]
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.data.shape
+
+
+def _grid_of(raster: Union[gu.Raster, _RasterArray]) -> _Grid:
+    return _Grid(raster.transform, raster.shape, raster.crs)
+
+
+def _read_raster_array(path: Path) -> _RasterArray:
+    with rasterio.open(path) as src:
+        return _RasterArray(
+            src.read(1, masked=True), src.transform, src.crs, src.nodata
+        )
+
+
+def _as_dem(dem: Union[str, Path, gu.Raster, xdem.DEM]) -> xdem.DEM:
+    """
+    Coerce a DEM given as a file path, gu.Raster or xdem.DEM object to an xdem.DEM object.
+
+    Parameters:
+        dem (Union[str, Path, gu.Raster, xdem.DEM]): Input DEM.
+
+    Returns:
+        xdem.DEM: The input DEM itself if it is already an xdem.DEM object, otherwise a new xdem.DEM object.
+
+    Raises:
+        TypeError: If the input DEM is not of type str, Path, gu.Raster, or xdem.DEM.
+    """
+    if isinstance(dem, xdem.DEM):
+        return dem
+    if isinstance(dem, (str, Path, gu.Raster)):
+        return xdem.DEM(dem)
+    raise TypeError("Input DEM must be a file path, gu.Raster, or xdem.DEM object.")
+
+
+def _as_raster_array(dem: Union[str, Path, gu.Raster]) -> _RasterArray:
+    """
+    Coerce a DEM given as a file path, gu.Raster or xdem.DEM object to a _RasterArray, without copying loaded data.
+
+    Parameters:
+        dem (Union[str, Path, gu.Raster]): Input DEM.
+
+    Returns:
+        _RasterArray: The DEM data and georeferencing.
+
+    Raises:
+        TypeError: If the input DEM is not of type str, Path, gu.Raster, or xdem.DEM.
+    """
+    if isinstance(dem, gu.Raster):
+        return _RasterArray(dem.data, dem.transform, dem.crs, dem.nodata)
+    if isinstance(dem, (str, Path)):
+        logger.info(f"Loading DEM from {dem}")
+        return _read_raster_array(Path(dem))
+    raise TypeError("Input DEM must be a file path, gu.Raster, or xdem.DEM object.")
+
+
+def _aligned_slices(
+    src: _RasterArray, match: Union[gu.Raster, _RasterArray, _Grid]
+) -> Optional[Tuple[slice, slice]]:
+    """
+    Get the array slices of a raster covering the grid of another one, if that grid is a pixel-aligned subset.
+
+    Parameters:
+        src (_RasterArray): Raster to slice.
+        match (Union[gu.Raster, _RasterArray, _Grid]): Raster or grid to cover.
+
+    Returns:
+        Optional[Tuple[slice, slice]]: Row and column slices of `src`, or None if the grids are not aligned.
+    """
+    if src.crs != match.crs:
+        return None
+
+    src_t, match_t = src.transform, match.transform
+    if src_t.b != 0 or src_t.d != 0 or match_t.b != 0 or match_t.d != 0:
+        return None
+
+    # Use absolute tolerances in pixels, as tolerances relative to the offsets would
+    # accept sub-pixel shifts far from the origin of the source grid
+    col_off = (match_t.c - src_t.c) / src_t.a
+    row_off = (match_t.f - src_t.f) / src_t.e
+    if (
+        abs(col_off - round(col_off)) >= ALIGNMENT_TOLERANCE
+        or abs(row_off - round(row_off)) >= ALIGNMENT_TOLERANCE
+    ):
+        return None
+
+    col_off, row_off = round(col_off), round(row_off)
+    height, width = match.shape
+
+    if (
+        row_off < 0
+        or col_off < 0
+        or row_off + height > src.shape[0]
+        or col_off + width > src.shape[1]
+    ):
+        return None
+
+    # The difference in pixel size must not add up to a shift across the covered grid
+    col_drift = abs(src_t.a - match_t.a) * (col_off + width) / abs(src_t.a)
+    row_drift = abs(src_t.e - match_t.e) * (row_off + height) / abs(src_t.e)
+    if col_drift >= ALIGNMENT_TOLERANCE or row_drift >= ALIGNMENT_TOLERANCE:
+        return None
+
+    return slice(row_off, row_off + height), slice(col_off, col_off + width)
+
+
+def _aligned_subset(
+    src: _RasterArray, match: Union[gu.Raster, _RasterArray, _Grid]
+) -> Optional[np.ma.MaskedArray]:
+    """
+    Get the part of a raster covering the grid of another one without resampling, if possible.
+
+    Parameters:
+        src (_RasterArray): Raster to subset.
+        match (Union[gu.Raster, _RasterArray, _Grid]): Raster or grid to cover.
+
+    Returns:
+        Optional[np.ma.MaskedArray]: A view of the data of `src` on the grid of `match`, or None if the grids are not aligned.
+    """
+    slices = _aligned_slices(src, match)
+    if slices is None:
+        return None
+
+    return src.data[slices]
+
+
+@njit(parallel=True, fastmath={"contract", "arcp", "reassoc"}, cache=True)
+def _bilinear_resample(src, src_inv_transform, ctrl_x, ctrl_y, step, row_offset, out):
+    """
+    Bilinearly interpolate a raster at target pixels whose coordinates are given on a control grid.
+
+    The coordinates of each target pixel, in the CRS of the raster, are first bilinearly
+    interpolated between the four surrounding control points. Points outside the raster
+    or next to a NaN source value are set to NaN.
+
+    Parameters:
+        src (np.ndarray): 2D source array, with NaN as nodata.
+        src_inv_transform (Tuple[float, ...]): First six coefficients of the inverse affine transform of the source.
+        ctrl_x (np.ndarray): 2D array of x coordinates of the control points, every `step` target pixels.
+        ctrl_y (np.ndarray): 2D array of y coordinates of the control points, with the same shape as `ctrl_x`.
+        step (int): Spacing of the control points in target pixels.
+        row_offset (int): Target row of the first row of `out`.
+        out (np.ndarray): 2D output array.
+    """
+    a, b, c, d, e, f = src_inv_transform
+    height, width = src.shape
+    for i in prange(out.shape[0]):
+        ki = (i + row_offset) // step
+        ui = (i + row_offset - ki * step) / step
+        for j in range(out.shape[1]):
+            kj = j // step
+            uj = (j - kj * step) / step
+            w00 = (1 - ui) * (1 - uj)
+            w01 = (1 - ui) * uj
+            w10 = ui * (1 - uj)
+            w11 = ui * uj
+            x = (
+                w00 * ctrl_x[ki, kj]
+                + w01 * ctrl_x[ki, kj + 1]
+                + w10 * ctrl_x[ki + 1, kj]
+                + w11 * ctrl_x[ki + 1, kj + 1]
+            )
+            y = (
+                w00 * ctrl_y[ki, kj]
+                + w01 * ctrl_y[ki, kj + 1]
+                + w10 * ctrl_y[ki + 1, kj]
+                + w11 * ctrl_y[ki + 1, kj + 1]
+            )
+
+            # Fractional position relative to the centre of the first source pixel
+            col = a * x + b * y + c - 0.5
+            row = d * x + e * y + f - 0.5
+            # Written so that NaN coordinates are treated as outside the raster
+            if not (
+                col >= -0.5
+                and row >= -0.5
+                and col <= width - 0.5
+                and row <= height - 0.5
+            ):
+                out[i, j] = np.nan
+                continue
+
+            col0 = min(max(int(np.floor(col)), 0), width - 2)
+            row0 = min(max(int(np.floor(row)), 0), height - 2)
+            tx = min(max(col - col0, 0.0), 1.0)
+            ty = min(max(row - row0, 0.0), 1.0)
+            top = (1 - tx) * src[row0, col0] + tx * src[row0, col0 + 1]
+            bottom = (1 - tx) * src[row0 + 1, col0] + tx * src[row0 + 1, col0 + 1]
+            out[i, j] = (1 - ty) * top + ty * bottom
+
+
+@functools.lru_cache(maxsize=8)
+def _get_transformer(src_crs: CRS, dst_crs: CRS) -> pyproj.Transformer:
+    return pyproj.Transformer.from_crs(
+        src_crs.to_wkt(), dst_crs.to_wkt(), always_xy=True
+    )
+
+
+def _sample_bilinear(
+    data: np.ndarray,
+    transform: Affine,
+    crs: CRS,
+    dst_transform: Affine,
+    dst_shape: Tuple[int, int],
+    dst_crs: CRS,
+    quantize_offset: Optional[float] = None,
+    control_step: int = CONTROL_STEP,
+) -> np.ndarray:
+    """
+    Bilinearly resample a smooth, low-resolution raster such as a geoid onto a target grid.
+
+    Only the target pixel centres on a control grid, every `control_step` pixels, are
+    transformed to the source CRS. The `_bilinear_resample` Numba kernel interpolates the
+    coordinates of the other pixels between them, which is exact when both grids share the
+    same CRS. If a quantization offset is given, the output is resampled and quantized to
+    int16 strip by strip.
+
+    Parameters:
+        data (np.ndarray): 2D source array, with NaN as nodata.
+        transform (Affine): Affine transform of the source array.
+        crs (CRS): CRS of the source array.
+        dst_transform (Affine): Affine transform of the target grid.
+        dst_shape (Tuple[int, int]): Shape of the target grid.
+        dst_crs (CRS): CRS of the target grid.
+        quantize_offset (Optional[float], optional): Offset used to quantize the output with `_quantize`. Defaults to None, i.e. no quantization.
+        control_step (int, optional): Spacing of the control points in target pixels. Defaults to CONTROL_STEP.
+
+    Returns:
+        np.ndarray: float32 array on the target grid, with NaN where the source has no data, or the quantized int16 array.
+    """
+    height, width = dst_shape
+    inv_transform = tuple(~transform)[:6]
+
+    # Control points every control_step pixels, with one more row and column past the
+    # last pixel so that every pixel has four surrounding control points
+    ctrl_rows = np.arange((height - 1) // control_step + 2) * control_step + 0.5
+    ctrl_cols = np.arange((width - 1) // control_step + 2) * control_step + 0.5
+    col_grid, row_grid = np.meshgrid(ctrl_cols, ctrl_rows)
+    ctrl_x, ctrl_y = dst_transform * (col_grid, row_grid)
+    if crs != dst_crs:
+        ctrl_x, ctrl_y = _get_transformer(dst_crs, crs).transform(ctrl_x, ctrl_y)
+
+    if quantize_offset is None:
+        out = np.empty(dst_shape, dtype=np.float32)
+        _bilinear_resample(data, inv_transform, ctrl_x, ctrl_y, control_step, 0, out)
+        return out
+
+    # Limit the size of the float32 buffer to about STRIP_PIXELS pixels
+    out = np.empty(dst_shape, dtype=np.int16)
+    strip_rows = max(1, STRIP_PIXELS // width)
+    for row_start in range(0, height, strip_rows):
+        out_strip = out[row_start : row_start + strip_rows]
+        strip = np.empty(out_strip.shape, dtype=np.float32)
+        _bilinear_resample(
+            data, inv_transform, ctrl_x, ctrl_y, control_step, row_start, strip
+        )
+        _quantize(strip, quantize_offset, out=out_strip)
+
+    return out
+
+
+def _quantization_offset(data: np.ma.MaskedArray) -> Optional[float]:
+    """
+    Get the offset to quantize geoid heights with, or None if their range does not fit in int16.
+
+    Parameters:
+        data (np.ma.MaskedArray): Geoid heights.
+
+    Returns:
+        Optional[float]: Median of the geoid heights, or None.
+    """
+    valid = np.ma.compressed(data)
+    if valid.size == 0:
+        return None
+
+    offset = float(np.median(valid))
+    if np.abs(valid - offset).max() * GEOID_SCALE >= np.iinfo(np.int16).max:
+        return None
+
+    return offset
+
+
+def _quantize(
+    data: np.ndarray, offset: float, out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Quantize heights to int16 multiples of 1 / GEOID_SCALE relative to an offset.
+
+    Parameters:
+        data (np.ndarray): Heights to quantize, with NaN as nodata.
+        offset (float): Offset subtracted before quantizing.
+        out (Optional[np.ndarray], optional): int16 array receiving the result. Defaults to a new array.
+
+    Returns:
+        np.ndarray: Quantized heights, with QUANTIZED_NODATA where the input is NaN.
+    """
+    if out is None:
+        out = np.empty(data.shape, dtype=np.int16)
+
+    nodata = np.isnan(data)
+    np.copyto(
+        out, np.rint((data - offset) * GEOID_SCALE), casting="unsafe", where=~nodata
+    )
+    out[nodata] = QUANTIZED_NODATA
+
+    return out
+
+
+@njit(parallel=True, cache=True)
+def _add_quantized(values, mask, quantized, scale, offset):
+    """
+    Add quantized heights to an array in place, as `values += quantized * scale + offset`.
+
+    Pixels already masked are skipped, and pixels where the quantized heights have no data
+    are masked.
+
+    Parameters:
+        values (np.ndarray): 2D array of heights to update.
+        mask (np.ndarray): 2D boolean mask of `values`, updated in place.
+        quantized (np.ndarray): 2D int16 array of quantized heights.
+        scale (float): Scale of the quantized heights.
+        offset (float): Offset of the quantized heights.
+    """
+    for i in prange(values.shape[0]):
+        for j in range(values.shape[1]):
+            if mask[i, j]:
+                continue
+            q = quantized[i, j]
+            if q == QUANTIZED_NODATA:
+                mask[i, j] = True
+            else:
+                values[i, j] += q * scale + offset
+
+
+def _resample_geoid(
+    geoid: _RasterArray,
+    match: Union[gu.Raster, _RasterArray, _Grid],
+    quantize: bool = False,
+) -> Union[np.ma.MaskedArray, _QuantizedGeoid]:
+    """
+    Bilinearly resample a geoid onto the grid of a DEM.
+
+    Parameters:
+        geoid (_RasterArray): Geoid to resample.
+        match (Union[gu.Raster, _RasterArray, _Grid]): Raster or grid defining the target grid (CRS, transform and shape).
+        quantize (bool, optional): Quantize the resampled heights to int16, unless their range is too large for it, to halve the memory they take. This costs an extra pass and up to 0.5 mm of rounding error, so it only pays off for results kept in memory. Defaults to False.
+
+    Returns:
+        Union[np.ma.MaskedArray, _QuantizedGeoid]: The geoid heights on the grid of the match raster.
+    """
+    offset = _quantization_offset(geoid.data) if quantize else None
+
+    subset = _aligned_subset(geoid, match)
+    if subset is not None:
+        if offset is None:
+            return subset
+        data = np.ma.filled(subset.astype(np.float32), np.nan)
+        return _QuantizedGeoid(_quantize(data, offset), offset)
+
+    data = np.ma.filled(geoid.data.astype(np.float32, copy=False), np.nan)
+    resampled = _sample_bilinear(
+        data,
+        geoid.transform,
+        geoid.crs,
+        match.transform,
+        match.shape,
+        match.crs,
+        quantize_offset=offset,
+    )
+    if offset is None:
+        return np.ma.masked_invalid(resampled, copy=False)
+
+    return _QuantizedGeoid(resampled, offset)
+
+
+def _warp_to(
+    src: _RasterArray,
+    dst: Union[gu.Raster, _RasterArray, _Grid],
+    resampling: str = "bilinear",
+) -> np.ma.MaskedArray:
+    """
+    Reproject a raster onto the grid of another raster using multi-threaded GDAL warping.
+
+    If the target grid is a pixel-aligned subset of the source grid, no warping is done and
+    a view of the source data is returned instead.
+
+    Parameters:
+        src (_RasterArray): Raster to reproject.
+        dst (Union[gu.Raster, _RasterArray, _Grid]): Raster or grid defining the target grid (CRS, transform and shape).
+        resampling (str, optional): Rasterio resampling method. Defaults to "bilinear".
+
+    Returns:
+        np.ma.MaskedArray: The source data warped onto the target grid.
+    """
+    subset = _aligned_subset(src, dst)
+    if subset is not None:
+        return subset
+
+    source = np.ma.filled(src.data.astype(np.float32, copy=False), np.nan)
+    destination = np.full(dst.shape, np.nan, dtype=np.float32)
+    rasterio.warp.reproject(
+        source=source,
+        destination=destination,
+        src_transform=src.transform,
+        src_crs=src.crs,
+        src_nodata=np.nan,
+        dst_transform=dst.transform,
+        dst_crs=dst.crs,
+        dst_nodata=np.nan,
+        resampling=Resampling[resampling],
+        num_threads=NUM_THREADS,
+        warp_mem_limit=WARP_MEM_LIMIT,
+    )
+
+    return np.ma.masked_invalid(destination, copy=False)
+
+
+@functools.lru_cache(maxsize=2)
+def _warp_geoid_cached(
+    geoid_path: Path, mtime_ns: int, grid: _Grid
+) -> Union[np.ma.MaskedArray, _QuantizedGeoid]:
+    return _resample_geoid(_read_raster_array(geoid_path), grid, quantize=True)
+
+
+def _warp_geoid(
+    geoid_path: Path, dem: Union[gu.Raster, _RasterArray], cached: bool = False
+) -> Union[np.ma.MaskedArray, _QuantizedGeoid]:
+    """
+    Warp a geoid file onto the grid of a DEM.
+
+    Parameters:
+        geoid_path (Path): Path to the geoid file.
+        dem (Union[gu.Raster, _RasterArray]): DEM defining the target grid.
+        cached (bool, optional): Reuse the result of previous calls for the same, unmodified file and grid, and keep this result in memory for later calls. The result is then stored as int16 where possible, and shared between calls so it must not be modified. Defaults to False.
+
+    Returns:
+        Union[np.ma.MaskedArray, _QuantizedGeoid]: The geoid heights on the grid of the DEM.
+    """
+    geoid_path = Path(geoid_path).resolve()
+    if not cached:
+        return _resample_geoid(_read_raster_array(geoid_path), dem)
+
+    return _warp_geoid_cached(geoid_path, geoid_path.stat().st_mtime_ns, _grid_of(dem))
+
+
+def _inplace_op(
+    op: np.ufunc,
+    a: np.ma.MaskedArray,
+    b: np.ma.MaskedArray,
+    out: Optional[np.ma.MaskedArray] = None,
+    strip_pixels: int = OP_STRIP_PIXELS,
+) -> np.ma.MaskedArray:
+    """
+    Apply a NumPy binary ufunc between two masked arrays on the same grid, writing the result in place.
+
+    Pixels masked in either array are skipped and masked in the output. The arrays are
+    traversed in contiguous strips of rows, so that the combined mask of each strip is
+    still in cache when the ufunc reads it.
+
+    Parameters:
+        op (np.ufunc): Binary ufunc to apply, e.g. np.add or np.subtract.
+        a (np.ma.MaskedArray): First operand.
+        b (np.ma.MaskedArray): Second operand.
+        out (Optional[np.ma.MaskedArray], optional): Array receiving the result. Defaults to `a`.
+        strip_pixels (int, optional): Approximate number of pixels in each strip of rows. Defaults to OP_STRIP_PIXELS.
+
+    Returns:
+        np.ma.MaskedArray: The output array.
+
+    Raises:
+        ValueError: If the two arrays do not have the same shape.
+    """
+    if a.shape != b.shape:
+        raise ValueError("Both rasters must share the same grid.")
+    if out is None:
+        out = a
+
+    a_mask = np.ma.getmaskarray(a)
+    b_mask = np.ma.getmaskarray(b)
+    out_mask = np.ma.getmaskarray(out)
+    height, width = a.shape
+    strip_rows = max(1, strip_pixels // width)
+    for y in range(0, height, strip_rows):
+        sl = slice(y, y + strip_rows)
+        mask = np.logical_or(a_mask[sl], b_mask[sl], out=out_mask[sl])
+        op(a.data[sl], b.data[sl], out=out.data[sl], where=~mask)
+    # Setting the mask copies it, so only do it if the output had no mask array
+    if out.mask is np.ma.nomask:
+        out.mask = out_mask
+
+    return out
+
+
+def _apply_geoid(
+    dem: np.ma.MaskedArray,
+    geoid: Union[np.ma.MaskedArray, _QuantizedGeoid],
+    sign: int,
+) -> None:
+    """
+    Add geoid heights to, or subtract them from, DEM heights in place.
+
+    Pixels masked in either input are masked in the DEM.
+
+    Parameters:
+        dem (np.ma.MaskedArray): DEM heights to update.
+        geoid (Union[np.ma.MaskedArray, _QuantizedGeoid]): Geoid heights on the same grid.
+        sign (int): 1 to add the geoid heights, -1 to subtract them.
+
+    Raises:
+        ValueError: If the DEM and geoid do not have the same shape.
+    """
+    if not isinstance(geoid, _QuantizedGeoid):
+        _inplace_op(np.add if sign > 0 else np.subtract, dem, geoid)
+        return
+
+    if dem.shape != geoid.values.shape:
+        raise ValueError("Both rasters must share the same grid.")
+
+    mask = np.ma.getmaskarray(dem)
+    _add_quantized(
+        dem.data, mask, geoid.values, sign / GEOID_SCALE, sign * geoid.offset
+    )
+    if dem.mask is np.ma.nomask:
+        dem.mask = mask
+
+
+def _save_dem(dem: gu.Raster, output_path: Path) -> None:
+    """
+    Save a DEM as a tiled, compressed GeoTIFF using the shared creation options.
+
+    Parameters:
+        dem (gu.Raster): DEM to save.
+        output_path (Path): Path to save the DEM.
+    """
+    co_opts = get_cog_opts(dem.dtype)
+    driver = co_opts.pop("driver")
+    dem.save(output_path, driver=driver, co_opts=co_opts)
+
+
+def _apply_geoid_windowed(
+    op: np.ufunc,
+    dem_path: Path,
+    geoid_path: Path,
+    output_path: Path,
+    target_crs: Optional[Union[int, str]] = None,
+    target_res: Optional[float] = None,
+    resampling: str = "cubic",
+) -> Path:
+    """
+    Apply a geoid to a DEM file block by block, writing each output block as soon as it is computed.
+
+    Only one output block of the DEM and of the warped geoid is held in memory at a time.
+
+    Parameters:
+        op (np.ufunc): Binary ufunc combining DEM and geoid heights, e.g. np.add or np.subtract.
+        dem_path (Path): Path to the input DEM file.
+        geoid_path (Path): Path to the geoid file.
+        output_path (Path): Path to save the output DEM.
+        target_crs (Optional[Union[int, str]], optional): EPSG code or PROJ string for the target CRS. If provided, the DEM is warped to this CRS on the fly. Defaults to None.
+        target_res (Optional[float], optional): Target resolution in units of the target CRS. If provided, the DEM is warped to this resolution on the fly. Defaults to None.
+        resampling (str, optional): Resampling method used to warp the DEM to the target grid. Defaults to "cubic".
+
+    Returns:
+        Path: Path to the saved output DEM.
+    """
+    # The geoid grids are small, so they are read once in full
+    with rasterio.open(geoid_path) as geoid_src:
+        geoid_data = geoid_src.read(1, masked=True).astype(np.float32).filled(np.nan)
+        geoid_transform = geoid_src.transform
+        geoid_crs = geoid_src.crs
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(exist_ok=True, parents=True)
+
+    with rasterio.open(dem_path) as src:
+        # Choose the output nodata first, so that the warped DEM marks the pixels outside
+        # the footprint of the source DEM with it even if the source has no nodata
+        nodata = src.nodata if src.nodata is not None else -9999
+        if target_crs is not None or target_res is not None:
+            dst_crs = target_crs if target_crs is not None else src.crs
+            dst_transform, width, height = rasterio.warp.calculate_default_transform(
+                src.crs,
+                dst_crs,
+                src.width,
+                src.height,
+                *src.bounds,
+                resolution=target_res,
+            )
+            reader = WarpedVRT(
+                src,
+                crs=dst_crs,
+                transform=dst_transform,
+                width=width,
+                height=height,
+                nodata=nodata,
+                resampling=Resampling[resampling],
+                warp_mem_limit=WARP_MEM_LIMIT,
+            )
+        else:
+            reader = src
+
+        profile = {
+            "height": reader.height,
+            "width": reader.width,
+            "count": 1,
+            "dtype": "float32",
+            "crs": reader.crs,
+            "transform": reader.transform,
+            "nodata": nodata,
+            **get_cog_opts("float32"),
+        }
+        with reader, rasterio.open(output_path, "w", **profile) as dst:
+            for _, window in dst.block_windows(1):
+                dem_block = reader.read(1, window=window, masked=True)
+                dem_block = dem_block.astype(np.float32, copy=False)
+                geoid_block = _sample_bilinear(
+                    geoid_data,
+                    geoid_transform,
+                    geoid_crs,
+                    window_transform(window, reader.transform),
+                    dem_block.shape,
+                    reader.crs,
+                )
+
+                values = dem_block.data
+                mask = np.ma.getmaskarray(dem_block) | np.isnan(geoid_block)
+                op(values, geoid_block, out=values, where=~mask)
+                values[mask] = nodata
+                dst.write(values, 1, window=window)
+
+    return output_path
+
+
+def _difference_windowed(
+    dem_path: Path, reference_dem_path: Path, output_path: Path
+) -> Path:
+    """
+    Compute the difference between two DEM files block by block, writing each output block as soon as it is computed.
+
+    The reference DEM is read through a WarpedVRT on the grid of the main DEM, so that it is
+    only warped block by block as it is read.
+
+    Parameters:
+        dem_path (Path): Path to the main DEM file.
+        reference_dem_path (Path): Path to the reference DEM file.
+        output_path (Path): Path to save the difference raster.
+
+    Returns:
+        Path: Path to the saved difference raster.
+    """
+    output_path = Path(output_path)
+    output_path.parent.mkdir(exist_ok=True, parents=True)
+
+    with rasterio.open(dem_path) as src, rasterio.open(reference_dem_path) as ref_src:
+        nodata = src.nodata if src.nodata is not None else -9999
+        profile = {
+            "height": src.height,
+            "width": src.width,
+            "count": 1,
+            "dtype": "float32",
+            "crs": src.crs,
+            "transform": src.transform,
+            "nodata": nodata,
+            **get_cog_opts("float32"),
+        }
+        with WarpedVRT(
+            ref_src,
+            crs=src.crs,
+            transform=src.transform,
+            width=src.width,
+            height=src.height,
+            nodata=np.nan,
+            dtype="float32",
+            resampling=Resampling.bilinear,
+            warp_mem_limit=WARP_MEM_LIMIT,
+            warp_extras={"NUM_THREADS": "ALL_CPUS"},
+        ) as vrt, rasterio.open(output_path, "w", **profile) as dst:
+            for _, window in dst.block_windows(1):
+                dem_block = src.read(1, window=window, masked=True)
+                dem_block = dem_block.astype(np.float32, copy=False)
+                reference_block = vrt.read(1, window=window)
+
+                values = dem_block.data
+                mask = np.ma.getmaskarray(dem_block) | np.isnan(reference_block)
+                np.subtract(values, reference_block, out=values, where=~mask)
+                values[mask] = nodata
+                dst.write(values, 1, window=window)
+
+    return output_path
+
 
 def transform_ln02_to_ellipsoid(
-    dem: Union[Path, gu.Raster, xdem.DEM],
+    dem: Union[str, Path, gu.Raster, xdem.DEM],
     chgeo2004_geoid_path: Path,
     target_crs: Optional[Union[int, str]] = None,
     resampling: str = "cubic",
+    target_res: Optional[float] = None,
+    output_path: Optional[Path] = None,
+    cache_geoid: bool = False,
+    inplace: bool = False,
     **kwarg,
 ) -> xdem.DEM:
     """
     Transforms the DEM from the Swiss LN02 vertical reference system (using CHGeo2004 geoid) to an ellipsoidal height reference. Optionally reprojects the DEM to a specified CRS.
 
     Parameters:
-        dem (Union[Path, gu.Raster, xdem.DEM]): Input DEM, either as a file path, gu.Raster, or xdem.DEM object.
+        dem (Union[str, Path, gu.Raster, xdem.DEM]): Input DEM, either as a file path, gu.Raster, or xdem.DEM object.
         chgeo2004_geoid_path (Path): Path to the CHGeo2004 geoid file for LN02 to ellipsoid conversion.
         target_crs (Optional[Union[int, str]], optional): EPSG code or PROJ string for the target CRS. If provided, the DEM will be reprojected to this CRS. Defaults to None.
         resampling (str, optional): Resampling method to use for reprojection. Any Rasterio resampling method can be used. Options include 'nearest', 'bilinear', 'cubic', etc. Defaults to "cubic".
-        **kwarg: Additional keyword arguments to pass to the xdem.DEM.reproject() method.
+        target_res (Optional[float], optional): Target resolution in units of the target CRS. If provided, the DEM is resampled to this resolution in the same warp as the CRS reprojection. Defaults to None.
+        output_path (Optional[Path], optional): Path to save the transformed DEM. If provided together with a DEM file path, the DEM is processed block by block without loading it in memory. Defaults to None.
+        cache_geoid (bool, optional): Keep the geoid resampled onto the DEM grid in memory, to reuse it for later DEMs on the same grid. Up to two grids are kept, stored as int16 millimetres where possible. Defaults to False.
+        inplace (bool, optional): Modify the input DEM object in place instead of a copy of it, to save memory. Ignored if the DEM is reprojected, which always returns a new object. Defaults to False.
+        **kwarg: Additional keyword arguments to pass to the xdem.DEM.reproject() method. Ignored when the DEM is processed block by block.
 
     Returns:
         xdem.DEM: The DEM transformed to ellipsoidal heights and reprojected to the target CRS if specified.
 
     Raises:
-        TypeError: If the input DEM is not of type Path, gu.Raster, or xdem.DEM.
+        TypeError: If the input DEM is not of type str, Path, gu.Raster, or xdem.DEM.
         FileNotFoundError: If the specified CHGeo2004 geoid file is not found.
         ValueError: If an invalid resampling method is provided.
     """
-    # Validate and load DEM if input is a path
-    if isinstance(dem, Path):
-        dem = xdem.DEM(dem)
-    elif isinstance(dem, gu.Raster):
-        dem = xdem.DEM(dem)
-    elif not isinstance(dem, xdem.DEM):
-        raise TypeError("Input DEM must be a file path, gu.Raster, or xdem.DEM object.")
-
     # Check that the geoid file exists
     if not chgeo2004_geoid_path.exists():
         raise FileNotFoundError(f"Geoid file not found at {chgeo2004_geoid_path}")
 
+    # Check the resampling method before any work, whichever path processes the DEM
+    if resampling not in Resampling.__members__:
+        raise ValueError(
+            f"Invalid resampling method '{resampling}'. Options are: {', '.join(Resampling.__members__)}."
+        )
+
+    # Convert target CRS to EPSG code if it's a strings
+    if target_crs is not None and not isinstance(target_crs, int):
+        target_crs = pyproj.CRS.from_user_input(target_crs).to_epsg()
+
+    # Stream the DEM file block by block if the output is written to disk
+    if isinstance(dem, (str, Path)) and output_path is not None:
+        logger.info("Adding CHGeo2004 geoid height to DEM block by block...")
+        output_path = _apply_geoid_windowed(
+            np.add,
+            Path(dem),
+            chgeo2004_geoid_path,
+            output_path,
+            target_crs=target_crs,
+            target_res=target_res,
+            resampling=resampling,
+        )
+        logger.info(f"Saved ellipsoidal DEM to {output_path}")
+        return xdem.DEM(output_path, vcrs="Ellipsoid")
+
+    # Validate and load DEM if input is a path
+    input_dem = dem
+    dem = _as_dem(dem)
+
+    # Optional: reproject to the target CRS and resolution first, so that the geoid is warped
+    # straight onto the final grid and the DEM is only warped once
+    if target_crs is not None or target_res is not None:
+        logger.info(
+            f"Reprojecting DEM to target CRS {target_crs} and resolution {target_res} using {resampling} resampling..."
+        )
+        kwarg.setdefault("n_threads", NUM_THREADS)
+        kwarg.setdefault("memory_limit", WARP_MEM_LIMIT)
+        dem = dem.reproject(
+            crs=target_crs, res=target_res, resampling=resampling, **kwarg
+        )
+
+    # Work on a copy, unless the caller asked for their DEM to be modified
+    if dem is input_dem and not inplace:
+        dem = dem.copy()
+
     # Load and reproject the geoid to match the DEM's grid and resolution
     logger.info("Reprojecting CHGeo2004 geoid to match DEM grid...")
-    geoid = xdem.DEM(chgeo2004_geoid_path)
-    geoid_warped = geoid.reproject(dem, resampling="bilinear")
+    geoid_warped = _warp_geoid(chgeo2004_geoid_path, dem, cached=cache_geoid)
 
     # Convert to ellipsoidal height by adding geoid values
     logger.info("Adding geoid height to DEM for conversion to ellipsoidal height...")
-    dem += geoid_warped
+    _apply_geoid(dem.data, geoid_warped, sign=1)
     dem.set_vcrs("Ellipsoid")
 
-    # Optional: reproject to the target CRS if specified
-    if target_crs is not None:
-        # Convert target CRS to EPSG code if it's a strings
-        if not isinstance(target_crs, int):
-            target_crs = pyproj.CRS.from_user_input(target_crs).to_epsg()
+    if output_path is not None:
+        output_path = Path(output_path)
+        output_path.parent.mkdir(exist_ok=True, parents=True)
+        _save_dem(dem, output_path)
+        logger.info(f"Saved ellipsoidal DEM to {output_path}")
+
+    return dem
+
 
-        logger.info(
-            f"Reprojecting DEM to target CRS {target_crs} using {resampling} resampling..."
+def _to_vcrs(dem: xdem.DEM, geoid: str) -> None:
+    """
+    Convert a DEM in place to a vertical CRS known to xdem, attempting to download the geoid grid automatically.
+
+    Parameters:
+        dem (xdem.DEM): DEM object to be converted.
+        geoid (str): Name of the vertical CRS, e.g. "Ellipsoid", "EGM08" or "EGM96".
+
+    Raises:
+        ValueError: If the DEM has no vertical coordinate system set.
+    """
+    if not dem.vcrs:
+        raise ValueError(
+            "The DEM must have a vertical coordinate system set before converting."
         )
-        dem.reproject(crs=target_crs, resampling=resampling, inplace=True, **kwarg)
 
-    return dem
+    logger.info(
+        f"Converting DEM to {geoid} vertical coordinate system using automatic data."
+    )
+    dem.to_vcrs(geoid, inplace=True)
+
+
+# Handlers for the geoids that can be given by name to convert_dem_vertical_datum
+_GEOID_DISPATCH = {"Ellipsoid": _to_vcrs, "EGM08": _to_vcrs, "EGM96": _to_vcrs}
 
 
 def convert_dem_vertical_datum(
-    dem: xdem.DEM,
+    dem: Union[str, Path, xdem.DEM],
     geoid: Union[Literal["Ellipsoid", "EGM08", "EGM96"], str, Path, xdem.DEM],
     output_path: Path = None,
+    cache_geoid: bool = False,
+    inplace: bool = False,
 ) -> xdem.DEM:
     """
     Convert DEM vertical height datum to/from ellipsoidal height or geoid-based vertical datum.
 
     Parameters:
-        dem (xdem.DEM): DEM object to be converted.
-        output_path (Path): Path to save the converted DEM.
+        dem (Union[str, Path, xdem.DEM]): DEM object or path to a DEM file to be converted.
+        output_path (Path): Path to save the converted DEM. If provided together with a DEM file path and a geoid file path, the DEM is processed block by block without loading it in memory.
         geoid (Literal["Ellipsoid", "EGM08", "EGM96"] | str | Path | xdem.DEM): Geoid model name, path, or DEM object.
+        cache_geoid (bool, optional): Keep a geoid file resampled onto the DEM grid in memory, to reuse it for later DEMs on the same grid. Up to two grids are kept, stored as int16 millimetres where possible. Defaults to False.
+        inplace (bool, optional): Modify the input DEM object in place instead of a copy of it, to save memory. Defaults to False.
 
     Returns:
         xdem.DEM: DEM converted to the specified vertical coordinate system.
     """
+    # Stream the DEM file block by block if both inputs are files and the output is
+    # written to disk. Strings are file paths unless they are known geoid names.
+    geoid_is_file = isinstance(geoid, Path) or (
+        isinstance(geoid, str) and geoid not in _GEOID_DISPATCH
+    )
+    if isinstance(dem, (str, Path)) and geoid_is_file and output_path is not None:
+        geoid = Path(geoid)
+        if not geoid.exists():
+            raise FileNotFoundError(f"Geoid file not found at {geoid}")
+
+        logger.info(f"Adjusting DEM based on geoid file {geoid} block by block...")
+        output_path = _apply_geoid_windowed(np.subtract, Path(dem), geoid, output_path)
+        logger.info(f"Saved converted DEM to {output_path}")
+        return xdem.DEM(output_path)
+
+    # Work on a copy, unless the caller asked for their DEM to be modified
+    input_dem = dem
+    dem = _as_dem(dem)
+    if dem is input_dem and not inplace:
+        dem = dem.copy()
+
+    # Known geoid names take precedence over file paths
+    handler = _GEOID_DISPATCH.get(geoid) if isinstance(geoid, str) else None
+    if handler is not None:
+        handler(dem, geoid)
+
     # Validate and load the geoid
-    if isinstance(geoid, (str, Path)):
+    elif isinstance(geoid, (str, Path)):
         geoid = Path(geoid)  # Ensure it's a Path if it's a string
 
         if not geoid.exists():
@@ -101,28 +948,15 @@ def convert_dem_vertical_datum(
 
         # Load and reproject the provided geoid file to match DEM
         logger.info(f"Loading geoid file from {geoid}")
-        geoid_dem = xdem.DEM(geoid)
-        geoid_warped = geoid_dem.reproject(dem, resampling="bilinear")
+        geoid_warped = _warp_geoid(geoid, dem, cached=cache_geoid)
         logger.info("Adjusting DEM based on provided geoid file...")
-        dem -= geoid_warped
+        _apply_geoid(dem.data, geoid_warped, sign=-1)
 
     elif isinstance(geoid, xdem.DEM):
         # If a geoid DEM object is provided, reproject it and apply
         logger.info("Using provided geoid DEM object for conversion.")
-        geoid_warped = geoid.reproject(dem, resampling="bilinear")
-        dem -= geoid_warped
-
-    elif isinstance(geoid, Literal) or geoid in ["Ellipsoid", "EGM08", "EGM96"]:
-        # For known literal geoids, attempt automatic download
-        if not dem.vcrs:
-            raise ValueError(
-                "The DEM must have a vertical coordinate system set before converting."
-            )
-
-        logger.info(
-            f"Converting DEM to {geoid} vertical coordinate system using automatic data."
-        )
-        dem.to_vcrs(geoid, inplace=True)
+        geoid_warped = _resample_geoid(_as_raster_array(geoid), dem)
+        _apply_geoid(dem.data, geoid_warped, sign=-1)
 
     else:
         raise TypeError(
@@ -133,7 +967,7 @@ def convert_dem_vertical_datum(
         # Save the output DEM
         output_path = Path(output_path)
         output_path.parent.mkdir(exist_ok=True, parents=True)
-        dem.save(output_path, co_opts={"BIGTIFF": "YES"})
+        _save_dem(dem, output_path)
         logger.info(f"Saved converted DEM to {output_path}")
 
     return dem
@@ -151,33 +985,34 @@ def compute_difference(
         output_diff_path (Path): Path to save the difference raster.
 
     Returns:
-        xdem.DEM: Difference raster object.
+        xdem.DEM: Difference raster object. If both DEMs are given as file paths, the difference is computed block by block and the returned object reads the saved raster lazily.
     """
-    # Load DEM from path if not already an xdem.DEM object
-    if isinstance(dem, Path):
-        logger.info(f"Loading main DEM from {dem}")
-        dem = xdem.DEM(dem)
-    elif not isinstance(dem, xdem.DEM):
-        raise TypeError(
-            "The 'dem' parameter must be either a Path or an xdem.DEM object."
-        )
+    # Stream both DEM files block by block
+    if isinstance(dem, Path) and isinstance(reference_dem, Path):
+        logger.info("Computing difference between DEMs block by block...")
+        output_diff_path = _difference_windowed(dem, reference_dem, output_diff_path)
+        logger.info(f"Saved difference raster to {output_diff_path}")
+        return xdem.DEM(output_diff_path)
 
-    # Load reference DEM from path if not already an xdem.DEM object
-    if isinstance(reference_dem, Path):
-        logger.info(f"Loading reference DEM from {reference_dem}")
-        reference_dem = xdem.DEM(reference_dem)
-    elif not isinstance(reference_dem, xdem.DEM):
-        raise TypeError(
-            "The 'reference_dem' parameter must be either a Path or an xdem.DEM object."
-        )
+    # Load the DEMs from path if not already xdem.DEM objects
+    dem = _as_raster_array(dem)
+    reference_dem = _as_raster_array(reference_dem)
 
     logger.info("Reprojecting reference DEM to match main DEM...")
-    reference_dem_warped = reference_dem.reproject(dem, resampling="bilinear")
+    reference_dem_warped = _warp_to(reference_dem, dem, resampling="bilinear")
 
     logger.info("Computing difference between DEMs...")
-    diff = dem - reference_dem_warped
+    # Write into the warped reference DEM, unless the warp was skipped and it still
+    # shares memory with the reference DEM of the caller
+    if np.may_share_memory(reference_dem_warped, reference_dem.data):
+        reference_dem_warped = reference_dem_warped.copy()
+    _inplace_op(np.subtract, dem.data, reference_dem_warped, out=reference_dem_warped)
 
-    diff.save(output_diff_path)
+    # Wrap the result into a DEM only to save and return it
+    diff = xdem.DEM.from_array(
+        reference_dem_warped, transform=dem.transform, crs=dem.crs, nodata=dem.nodata
+    )
+    _save_dem(diff, output_diff_path)
     logger.info(f"Saved difference raster to {output_diff_path}")
     return diff
 
@@ -190,26 +1025,25 @@ if __name__ == "__main__":
     final_resolution = 5
 
     output_dir = Path("outputs")
-    output_path = output_dir / f"swissalti3d_aletsch_{target_crs}_EGM08.tif"
+    output_path = (
+        output_dir / f"swissalti3d_aletsch_{target_crs}_EGM08_{final_resolution}m.tif"
+    )
     output_dir.mkdir(exist_ok=True, parents=True)
 
-    # Step 1: Reproject DEM to ellipsoid and optionally to target CRS
+    # Step 1: Reproject DEM to ellipsoid and to the target CRS and final resolution
     dem_ETRS89 = transform_ln02_to_ellipsoid(
         dem=dem_path,
         chgeo2004_geoid_path=chgeo2004_geoid_path,
         target_crs=target_crs,
+        target_res=final_resolution,
     )
 
-    # Step 2: Convert the vertical datum to EGM08
+    # Step 2: Convert the vertical datum to EGM08 and save the final DEM
     dem_EGM08 = convert_dem_vertical_datum(
         dem=dem_ETRS89,
         geoid=egm08_geoid_path,
-    )
-
-    # Downsample and save the final DEM
-    dem_EGM08 = dem_EGM08.reproject(res=final_resolution, resampling="bilinear")
-    dem_EGM08.save(
-        output_dir / f"swissalti3d_aletsch_{target_crs}_EGM08_{final_resolution}m.tif"
+        output_path=output_path,
+        inplace=True,
     )
 
     logger.info("Processing completed successfully.")
@@ -0,0 +1,31 @@
+import numpy as np
+from numpy.typing import DTypeLike
+
+# Creation options shared by every GeoTIFF written by these scripts: tiled,
+# DEFLATE-compressed BigTIFFs, compressed with all the available cores
+COG_OPTS = {
+    "driver": "GTiff",
+    "tiled": True,
+    "blockxsize": 512,
+    "blockysize": 512,
+    "compress": "DEFLATE",
+    "BIGTIFF": "YES",
+    "NUM_THREADS": "ALL_CPUS",
+}
+
+
+def get_cog_opts(dtype: DTypeLike) -> dict:
+    """
+    Get the GeoTIFF creation options for a raster of the given data type.
+
+    Floating-point rasters use the floating-point predictor (PREDICTOR=3), integer
+    rasters use horizontal differencing (PREDICTOR=2).
+
+    Parameters:
+        dtype (DTypeLike): Data type of the raster to write.
+
+    Returns:
+        dict: COG_OPTS with the matching predictor, to pass to rasterio.open().
+    """
+    predictor = 3 if np.dtype(dtype).kind == "f" else 2
+    return {**COG_OPTS, "predictor": predictor}
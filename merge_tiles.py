@@ -1,14 +1,23 @@
 import json
 import logging
 import os
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional, Union
 
 import rasterio
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
+from rasterio.dtypes import dtype_rev, typename_fwd
+from rasterio.env import get_gdal_config
+from rasterio.io import DatasetReader
 from rasterio.merge import merge
+from rasterio.shutil import copy
 from tqdm import tqdm
 
+from gtiff_options import get_cog_opts
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -17,6 +26,19 @@ logging.basicConfig(
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Let GDAL use all cores for decoding and a large block cache. Set through the
+# environment so that joblib worker processes inherit it. GDAL_CACHEMAX is a share of
+# the RAM for each process, so _merge_chunks splits it between its workers.
+os.environ.setdefault("GDAL_NUM_THREADS", "ALL_CPUS")
+os.environ.setdefault("GDAL_CACHEMAX", "25%")
+
+# Number of rasters above which merge_rasters builds a VRT mosaic instead of
+# merging in memory
+VRT_THRESHOLD = 100
+
+# Number of files merged together at each level of the merge tree
+MERGE_TREE_ARITY = 4
+
 
 # Extract the third number from the filename
 def get_chunk_id(file_path: Path) -> int:
@@ -51,48 +73,135 @@ def create_chunks(
         # "swissalti3d_2019_2654-1137_2_2056_5728"
         # subdide time images in chunks based on the third number in the filename ("2654" in the example above)
 
-        # Sort the files based on the third number in the filename
-        sorted_tiles = sorted(tiles_paths, key=get_chunk_id)
-        chunks = {}
-        for i, tile in enumerate(sorted_tiles):
-            chunk_id = get_chunk_id(tile)
-            if chunk_id not in chunks:
-                chunks[chunk_id] = []
-            chunks[chunk_id].append(tile)
+        # Parse the chunk id of each file once, then sort and group the files by it
+        ids = [get_chunk_id(tile) for tile in tiles_paths]
+        order = sorted(range(len(ids)), key=ids.__getitem__)
+        chunks = {
+            chunk_id: [tiles_paths[i] for i in indices]
+            for chunk_id, indices in groupby(order, key=ids.__getitem__)
+        }
 
     return chunks
 
 
-def merge_rasters(rasters: List[Path], ouput_path: Path) -> Path:
+def _open_raster(raster: Path) -> Optional[DatasetReader]:
+    try:
+        return rasterio.open(raster)
+    except Exception as e:
+        logger.error(f"Error opening raster {raster}: {e}")
+        return None
+
+
+def _write_mosaic_vrt(datasets: List[DatasetReader], vrt_path: Path) -> Path:
+    """
+    Write a VRT mosaic of rasters sharing the same CRS, resolution and data type.
+
+    Where rasters overlap, the first one in the list takes precedence, as in rasterio.merge.merge.
+
+    Parameters:
+        datasets (List[DatasetReader]): Open rasters to include in the mosaic.
+        vrt_path (Path): Path to save the VRT file.
+
+    Returns:
+        Path: Path to the saved VRT file.
+    """
+    first = datasets[0]
+    res_x, res_y = first.res
+    left = min(dataset.bounds.left for dataset in datasets)
+    bottom = min(dataset.bounds.bottom for dataset in datasets)
+    right = max(dataset.bounds.right for dataset in datasets)
+    top = max(dataset.bounds.top for dataset in datasets)
+
+    root = ET.Element(
+        "VRTDataset",
+        rasterXSize=str(round((right - left) / res_x)),
+        rasterYSize=str(round((top - bottom) / res_y)),
+    )
+    ET.SubElement(root, "SRS").text = first.crs.to_wkt()
+    ET.SubElement(root, "GeoTransform").text = (
+        f"{left!r}, {res_x!r}, 0.0, {top!r}, 0.0, {-res_y!r}"
+    )
+    for band in range(1, first.count + 1):
+        band_element = ET.SubElement(
+            root,
+            "VRTRasterBand",
+            dataType=typename_fwd[dtype_rev[first.dtypes[band - 1]]],
+            band=str(band),
+        )
+        if first.nodata is not None:
+            ET.SubElement(band_element, "NoDataValue").text = repr(first.nodata)
+
+        # Later sources are drawn on top, so add them in reverse order
+        for dataset in reversed(datasets):
+            source = ET.SubElement(band_element, "ComplexSource")
+            ET.SubElement(source, "SourceFilename", relativeToVRT="0").text = str(
+                Path(dataset.name).resolve()
+            )
+            ET.SubElement(source, "SourceBand").text = str(band)
+            ET.SubElement(
+                source,
+                "SrcRect",
+                xOff="0",
+                yOff="0",
+                xSize=str(dataset.width),
+                ySize=str(dataset.height),
+            )
+            ET.SubElement(
+                source,
+                "DstRect",
+                xOff=str(round((dataset.bounds.left - left) / res_x)),
+                yOff=str(round((top - dataset.bounds.top) / res_y)),
+                xSize=str(round(dataset.width * dataset.res[0] / res_x)),
+                ySize=str(round(dataset.height * dataset.res[1] / res_y)),
+            )
+            if dataset.nodata is not None:
+                ET.SubElement(source, "NODATA").text = repr(dataset.nodata)
+
+    ET.ElementTree(root).write(vrt_path)
+
+    return vrt_path
+
+
+def merge_rasters(
+    rasters: List[Path], ouput_path: Path, vrt_threshold: int = VRT_THRESHOLD
+) -> Path:
     # Open all the rasters using rasterio
     logger.info("Opening raster tiles...")
 
-    datasets = []
-    for raster in rasters:
-        try:
-            datasets.append(rasterio.open(raster))
-        except Exception as e:
-            logger.error(f"Error opening raster {raster}: {e}")
-            return None
-
-    # Merge the datasets
+    # Opening a raster only reads its headers, so the opens are I/O bound and
+    # can run in threads
+    with ThreadPoolExecutor(max_workers=min(32, len(rasters))) as executor:
+        datasets = list(executor.map(_open_raster, rasters))
+
+    if any(dataset is None for dataset in datasets):
+        for dataset in datasets:
+            if dataset is not None:
+                dataset.close()
+        return None
+
+    # Merge large sets of rasters through a VRT, which GDAL copies block by block
+    # instead of building the whole mosaic in memory
+    if len(datasets) > vrt_threshold:
+        logger.info("Merging raster tiles through a VRT mosaic...")
+        vrt_path = Path(ouput_path).with_suffix(".vrt")
+        _write_mosaic_vrt(datasets, vrt_path)
+        cog_opts = get_cog_opts(datasets[0].dtypes[0])
+        for dataset in datasets:
+            dataset.close()
+
+        copy(vrt_path, ouput_path, **cog_opts)
+        vrt_path.unlink()
+
+        return ouput_path
+
+    # Merge the datasets, writing the mosaic to the output file window by window
+    # instead of building it in memory first
     logger.info("Merging raster tiles...")
-
-    merged, out_transform = merge(datasets)
-
-    # Extract metadata from the first raster to use as the base for the output
-    logger.info("Saving merged raster...")
-    out_meta = datasets[0].meta.copy()
-    out_meta.update(
-        {
-            "driver": "GTiff",
-            "height": merged.shape[1],
-            "width": merged.shape[2],
-            "transform": out_transform,
-        }
+    merge(
+        datasets,
+        dst_path=ouput_path,
+        dst_kwds=get_cog_opts(datasets[0].dtypes[0]),
     )
-    with rasterio.open(ouput_path, "w", **out_meta) as dest:
-        dest.write(merged)
 
     # Close all datasets
     for dataset in datasets:
@@ -101,13 +210,15 @@ def merge_rasters(rasters: List[Path], ouput_path: Path) -> Path:
     return ouput_path
 
 
-def merge_tiles_chunk(tiles_paths: List[Path], chunk_id: int, out_dir: Path) -> Path:
+def merge_tiles_chunk(
+    tiles_paths: List[Path], chunk_id: Union[int, str], out_dir: Path
+) -> Path:
     """
     Merge a chunk of raster tiles into a single raster and save it as a temporary file.
 
     Parameters:
         tiles_paths (List[Path]): List of paths to raster tiles in the chunk.
-        chunk_id (int): Identifier for the chunk.
+        chunk_id (Union[int, str]): Identifier for the chunk.
         out_dir (Path): Directory to save the intermediate merged chunk file.
 
     Returns:
@@ -123,6 +234,66 @@ def merge_tiles_chunk(tiles_paths: List[Path], chunk_id: int, out_dir: Path) ->
     return chunk_output_path
 
 
+def _merge_tiles_chunk_worker(
+    tiles_paths: List[Path], chunk_id: Union[int, str], out_dir: Path, cache_max: int
+) -> Path:
+    """
+    Merge a chunk of raster tiles in a worker process, with a GDAL block cache of the given size.
+
+    Parameters:
+        tiles_paths (List[Path]): List of paths to raster tiles in the chunk.
+        chunk_id (Union[int, str]): Identifier for the chunk.
+        out_dir (Path): Directory to save the intermediate merged chunk file.
+        cache_max (int): Size of the GDAL block cache in bytes.
+
+    Returns:
+        Path: Path to the saved intermediate merged chunk file.
+    """
+    with rasterio.Env(GDAL_CACHEMAX=cache_max):
+        return merge_tiles_chunk(tiles_paths, chunk_id, out_dir)
+
+
+def _merge_chunks(
+    chunks: Dict[Union[int, str], List[Path]],
+    out_dir: Path,
+    parallel: bool,
+    processes: int,
+) -> List[Path]:
+    """
+    Merge each chunk of rasters into a single raster saved in a directory.
+
+    Parameters:
+        chunks (Dict[Union[int, str], List[Path]]): Dictionary with chunk identifiers as keys and list of raster paths as values.
+        out_dir (Path): Directory to save the merged chunk files.
+        parallel (bool): Merge the chunks in parallel processes.
+        processes (int): Number of processes used when parallel is True, as interpreted by joblib, i.e. negative values count back from the number of CPUs.
+
+    Returns:
+        List[Path]: Paths to the merged chunk files, in the order of the chunks.
+    """
+    if parallel:
+        # Split the GDAL block cache of this process between the workers, so that
+        # together they do not use more RAM than a single process would
+        with rasterio.Env():
+            cache_max = get_gdal_config("GDAL_CACHEMAX") // effective_n_jobs(processes)
+
+        logger.info("Starting parallel merging of chunks...")
+        with Parallel(n_jobs=processes, verbose=10) as parallel:
+            chunk_files = parallel(
+                delayed(_merge_tiles_chunk_worker)(
+                    chunk_paths, chunk_id, out_dir, cache_max
+                )
+                for chunk_id, chunk_paths in chunks.items()
+            )
+    else:
+        chunk_files = []
+        for chunk_id, chunk_paths in tqdm(chunks.items()):
+            chunk_file = merge_tiles_chunk(chunk_paths, chunk_id, out_dir)
+            chunk_files.append(chunk_file)
+
+    return chunk_files
+
+
 def merge_tiles(
     tiles_paths: List[Path],
     output_path: Path = None,
@@ -130,20 +301,34 @@ def merge_tiles(
     parallel: bool = False,
     processes: int = -1,
     keep_temp_files: bool = True,
+    tree_arity: int = MERGE_TREE_ARITY,
 ) -> Path:
     """
     Merge multiple raster tiles into a single raster.
 
+    If there are more tiles than max_chunk_tiles, the tiles are first merged in chunks, and
+    the chunk files are then merged in a tree, tree_arity files at a time, so that no merge
+    loads more than a few chunk files at once.
+
     Parameters:
         tiles_paths (List[Path]): List of paths to raster tiles.
         output_path (Path, optional): Path to save the merged raster.
         max_tiles (int, optional): Maximum number of tiles to process in a single chunk.
+        parallel (bool, optional): Merge the chunks, and each level of the merge tree, in parallel processes.
+        processes (int, optional): Number of processes used when parallel is True. Defaults to -1, i.e. a quarter of the CPUs, as GDAL already uses all cores within each process.
+        keep_temp_files (bool, optional): Keep the intermediate chunk files.
+        tree_arity (int, optional): Number of files merged together at each level of the merge tree. Defaults to MERGE_TREE_ARITY.
 
     Returns:
         Path: Path to the saved merged raster.
+
+    Raises:
+        ValueError: If no tiles are given, or if tree_arity is lower than 2.
     """
     if not tiles_paths:
         raise ValueError("No tiles found for merging.")
+    if tree_arity < 2:
+        raise ValueError("tree_arity must be at least 2.")
     logger.info(f"Found {len(tiles_paths)} tiles to merge.")
 
     if len(tiles_paths) <= max_chunk_tiles:
@@ -166,34 +351,43 @@ def merge_tiles(
     # Create chunks of tiles based on the max number of tiles per chunk
     chunks = create_chunks(tiles_paths, approach="filename")
 
-    # Write the chunks to a JSON file
-    with open(temp_dir_path / "chunks.json", "w") as f:
-        file_names_dict = {
-            chunk_id: [str(path.name) for path in chunk_paths]
-            for chunk_id, chunk_paths in chunks.items()
-        }
-        json.dump(file_names_dict, f, indent=4)
+    # Write the chunks to a JSON Lines file for debugging, one line per chunk
+    if keep_temp_files:
+        with open(temp_dir_path / "chunks.jsonl", "w") as f:
+            for chunk_id, chunk_paths in chunks.items():
+                f.write(
+                    json.dumps({chunk_id: [path.name for path in chunk_paths]}) + "\n"
+                )
 
     logger.info(f"Created {len(chunks)} chunks of tiles to merge.")
 
+    if processes == -1:
+        processes = max(1, os.cpu_count() // 4)
+
     # Merge each chunk
-    if parallel:
-        if processes == -1:
-            processes = os.cpu_count()
+    chunk_files = _merge_chunks(chunks, temp_dir_path, parallel, processes)
+
+    # Merge the chunk files in groups of consecutive files, level by level, until few
+    # enough remain for the final merge. Keeping the groups in order preserves which
+    # raster takes precedence where they overlap.
+    level = 0
+    while len(chunk_files) > tree_arity:
+        level += 1
+        groups = {
+            f"{level}-{i}": chunk_files[start : start + tree_arity]
+            for i, start in enumerate(range(0, len(chunk_files), tree_arity))
+        }
+        logger.info(
+            f"Merging {len(chunk_files)} files into {len(groups)} at level {level} of the merge tree..."
+        )
+        level_files = _merge_chunks(groups, temp_dir_path, parallel, processes)
 
-        logger.info("Starting parallel merging of chunks...")
-        with Parallel(n_jobs=processes, verbose=10) as parallel:
-            chunk_files = parallel(
-                delayed(merge_tiles_chunk)(chunk_paths, chunk_id, temp_dir_path)
-                for chunk_id, chunk_paths in chunks.items()
-            )
-    else:
-        chunk_files = []
-        for chunk_id, chunk_paths in tqdm(chunks.items()):
-            chunk_file = merge_tiles_chunk(chunk_paths, chunk_id, temp_dir_path)
-            chunk_files.append(chunk_file)
+        if not keep_temp_files:
+            for chunk_file in chunk_files:
+                chunk_file.unlink()
+        chunk_files = level_files
 
-    # Merge all temporary chunk files into the final output
+    # Merge the remaining temporary chunk files into the final output
     logger.info("Merging all chunks into the final raster...")
     merged_raster = merge_rasters(chunk_files, output_path)
 